@@ -1,32 +1,84 @@
 import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from enum import StrEnum
+import functools
 from typing import Optional
 import aiosqlite
-import json
-from telegram.ext import BasePersistence
-
-import aiosqlite
-from typing import Any, Optional, List
+from cachetools import TTLCache
+import orjson
 import logging
 
-from bot.helpers import normalize_fullname, normalize_name, normalize_phone
+from bot.helpers import normalize_name
+
+# hot statements, sqlite3 keeps them prepared in the connection statement cache
+_SELECT_CUSTOMER = """
+    SELECT id, fullname, phone, balance, created_at
+    From customers
+    WHERE id = ? AND admin_id = ?;
+"""
+_UPDATE_BALANCE = """
+    UPDATE customers SET balance = balance + ? WHERE id = ? RETURNING balance, fullname;
+"""
+_INSERT_TRANSACTION = """
+    INSERT INTO transactions (amount, type, customer_id, admin_id, description)
+    VALUES (?, ?, ?, ?, ?)
+    RETURNING id, amount, type, customer_id, admin_id, description, created_at;
+"""
+_INSERT_ACTION_LOG = """
+    INSERT INTO action_logs (action_type, customer_id, admin_id, payload)
+    VALUES (?, ?, ?, ?);
+"""
 
 class AppError(Exception):
     """Represents an intentional, user-facing application error."""
     pass
 
+class ActionType(StrEnum):
+    """action types stored in action_logs (they compare and hash equal to their stored strings)"""
+    ADD_CUSTOMER = "add_customer"
+    DELETE_CUSTOMER = "delete_customer"
+    RENAME_CUSTOMER = "rename_customer"
+    CHANGE_PHONE = "change_phone"
+    ADD_TRANSACTION = "add_transaction"
+
+def serialized(method):
+    """
+    Run a DatabaseManager method under its write lock.
+    handlers of different chats run concurrently but share one write connection, so their transactions must not interleave.
+    every locked method commits or rolls back before returning, so nothing uncommitted outlives the lock.
+    plain reads use `read_conn` instead: it only sees committed data, so they don't need the lock.
+    """
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        async with self._write_lock:
+            return await method(self, *args, **kwargs)
+    return wrapper
+
 class DatabaseManager:
     def __init__(self, db_path: str):
         self.db_path = db_path
         self.conn: aiosqlite.Connection = None
+        self.read_conn: aiosqlite.Connection = None # query_only, WAL gives it the last committed state
+        self._write_lock = asyncio.Lock()
+        # customer_id -> (admin_id, customer); only holds committed rows, dropped on every change
+        self._customer_cache: TTLCache = TTLCache(maxsize=10_000, ttl=30)
+        self._cache_generation = 0 # bumped on every invalidation, see get_customer_by_id
         self.logger = logging.getLogger(__name__)
 
     async def init_database(self):
         """Create required tables if they don't exist."""
         
-        self.conn = await aiosqlite.connect(self.db_path)
+        # one connection is shared by all handlers (via bot_data); keep its prepared statements cached
+        self.conn = await aiosqlite.connect(self.db_path, cached_statements=1024)
 
         await self.conn.execute("PRAGMA foreign_keys = ON;")
+        # WAL: a commit is a single append and readers don't block the writer
+        await self.conn.execute("PRAGMA journal_mode = WAL;")
+        await self.conn.execute("PRAGMA synchronous = NORMAL;")
+        await self.conn.execute("PRAGMA temp_store = MEMORY;")
+        await self.conn.execute("PRAGMA cache_size = -64000;") # 64MB
+        await self.conn.execute("PRAGMA busy_timeout = 5000;")
+        await self.conn.execute("PRAGMA mmap_size = 268435456;") # 256MB
         await self.conn.execute("""
             CREATE TABLE IF NOT EXISTS customers (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -64,29 +116,51 @@ class DatabaseManager:
             AS SELECT * FROM action_logs WHERE 0;
         """)
 
+        # summary totals are read from the index alone (covering), search filters by admin in name order.
+        # action_logs index on admin_id also holds the rowid, so "ORDER BY id DESC" needs no sort
+        await self.conn.executescript("""
+            CREATE INDEX IF NOT EXISTS ix_txn_cust_admin_type ON transactions(customer_id, admin_id, type, amount);
+            CREATE INDEX IF NOT EXISTS ix_cust_admin_fullname ON customers(admin_id, fullname);
+            CREATE INDEX IF NOT EXISTS ix_actionlog_admin ON action_logs(admin_id);
+        """)
+
         await self.conn.commit()
         self.conn.row_factory = aiosqlite.Row
 
+        # reads on the write connection would see other handlers' uncommitted (maybe rolled back) changes
+        self.read_conn = await aiosqlite.connect(self.db_path, cached_statements=1024)
+        await self.read_conn.execute("PRAGMA query_only = ON;")
+        await self.read_conn.execute("PRAGMA temp_store = MEMORY;")
+        await self.read_conn.execute("PRAGMA cache_size = -64000;") # 64MB
+        await self.read_conn.execute("PRAGMA busy_timeout = 5000;")
+        await self.read_conn.execute("PRAGMA mmap_size = 268435456;") # 256MB
+        self.read_conn.row_factory = aiosqlite.Row
+
     #  CUSTOMER Methods
 
-    async def search_customers(self, query: str, limit: int, admin_id: int) -> list[dict[str, str]]:
+    def _forget_customer(self, customer_id: int) -> None:
+        """drop a cached customer before changing it"""
+        self._customer_cache.pop(customer_id, None)
+        self._cache_generation += 1
+
+    async def search_customers(self, query: str, limit: int, admin_id: int) -> list[tuple[int, str]]:
         """
-        returns all customers with names that contain 'query' as a substring
-        e.g. query="ali" >> [{"id": 17, "fullname": "Ali Hassan"},  {"id": 42, "fullname": "Ali Omar"}]
+        returns (id, uppercase fullname) of all customers with names that contain 'query' as a substring
+        e.g. query="ali" >> [(17, "ALI HASSAN"), (42, "ALI OMAR")]
         """
         # normalize input
         query_normalized = normalize_name(query)
 
         # Execute SQL search
-        async with self.conn.execute("""
-            SELECT id, fullname
+        async with self.read_conn.execute("""
+            SELECT id, UPPER(fullname)
             FROM customers
             WHERE (fullname LIKE ? OR phone LIKE ?) AND admin_id = ?
             ORDER BY fullname ASC
             LIMIT ?;
         """, (f"%{query_normalized}%", f"%{query_normalized}%", admin_id, limit)) as cur:
             rows = await cur.fetchall()
-            return [dict(row) for row in rows]
+            return [tuple(row) for row in rows]
 
     async def restore_customer(self, temp_id, customer_info: dict):
         try:
@@ -95,6 +169,7 @@ class DatabaseManager:
             if missing:
                 raise AppError(f"Missing required keys: {', '.join(missing)}")
             customer_info.update({'temp_id':temp_id})
+            self._forget_customer(customer_info['customer_id'])
             cursor = await self.conn.execute(
                 """
                 UPDATE customers
@@ -114,26 +189,32 @@ class DatabaseManager:
             self.logger.exception(f"{exc}")
             raise Exception(f"Unexpected Error: {exc}") from exc
 
-    async def add_customer(self, fullname: str, phone: Optional[str], admin_id: int, with_logging=True, old_info=None) -> int:
+    @serialized
+    async def add_customer(self, fullname: str, phone: Optional[str], admin_id: int, with_logging=True, old_info=None) -> dict:
         """
-        Insert a new customer record and return its generated ID.
+        Insert a new customer record and return its generated ID and the inserted row (as 'customer').
         **old_info**: must include (customer_id, created_at, balance) of restored customer. only used to undo customer_delete command
+        its optional 'customer_transactions' are restored in the same db transaction
         """
         try:
             cursor = await self.conn.execute(
                 """
                 INSERT INTO customers (fullname, phone, admin_id)
                 VALUES (?, ?, ?)
-                RETURNING id;
+                -- RETURNING reports the column default before REAL affinity is applied
+                RETURNING id AS customer_id, fullname, phone, CAST(balance AS REAL) AS balance, created_at;
                 """,
                 (fullname, phone, admin_id),
             )
-            customer_id = (await cursor.fetchone())['id']
+            customer = dict(await cursor.fetchone())
+            customer_id = customer['customer_id']
             if with_logging:
-                await self.add_action_log('add_customer', customer_id, admin_id, {})
+                await self.add_action_log(ActionType.ADD_CUSTOMER, customer_id, admin_id, {}, False)
             undo_details = None
             if old_info:
                 customer_info = await self.restore_customer(customer_id, old_info)
+                if old_info.get('customer_transactions'):
+                    await self.restore_transactions(old_info['customer_transactions'], with_commit=False)
 
                 undo_details = {
                     "Full Name": fullname,
@@ -142,8 +223,13 @@ class DatabaseManager:
                 }
 
             await self.conn.commit()
-            customer_id = customer_id if old_info == None else old_info['customer_id']
-            return {'customer_id':customer_id, 'undo_details': undo_details}
+            if old_info is None:
+                # the inserted row is already known, no need to select it again
+                self._customer_cache[customer_id] = (admin_id, dict(customer))
+            else:
+                customer_id = old_info['customer_id']
+                customer = None
+            return {'customer_id':customer_id, 'customer': customer, 'undo_details': undo_details}
 
         except aiosqlite.IntegrityError as err:
             await self.conn.rollback()
@@ -152,76 +238,70 @@ class DatabaseManager:
             ) from err
 
         except Exception as exc:
-            self.conn.rollback()
+            await self.conn.rollback()
             self.logger.exception(f"{exc}")
             raise Exception(f"Unexpected Error: {exc}") from exc
 
     async def get_customer_by_id(self, customer_id: int, admin_id: int) -> Optional[dict]:
         """Retrieve a customer dict by id."""
 
-        async with self.conn.execute(
-            """
-            SELECT id, fullname, phone, balance, created_at
-            From customers
-            WHERE id = ? AND admin_id = ?;
-            """, (customer_id, admin_id)    
-        ) as cur:
+        # while a write is in progress the row may be replaced by its commit, so skip the cache
+        use_cache = not self._write_lock.locked()
+        if use_cache and customer_id in self._customer_cache:
+            cached_admin_id, customer = self._customer_cache[customer_id]
+            return dict(customer) if cached_admin_id == admin_id else None
+        generation = self._cache_generation
+
+        async with self.read_conn.execute(_SELECT_CUSTOMER, (customer_id, admin_id)) as cur:
             row = await cur.fetchone()
             if row:
                 customer = dict(row)
                 customer['fullname'] = customer.get('fullname')
                 customer['customer_id'] = customer.pop('id')
+                # a change invalidated during the fetch would leave this row stale
+                if use_cache and generation == self._cache_generation:
+                    self._customer_cache[customer_id] = (admin_id, dict(customer))
                 return customer
 
     async def get_customer_summary(self, customer_id: int, admin_id: int) -> dict | None:
 
-        customer_data = dict()
-        customer = await self.get_customer_by_id(customer_id, admin_id)
+        # customer info + transactions totals in one query
+        async with self.read_conn.execute("""
+            SELECT c.id AS customer_id, c.fullname, c.phone, c.balance, c.created_at,
+                TOTAL(CASE WHEN t.type = 'sale' THEN t.amount ELSE 0.0 END) AS sales,
+                TOTAL(CASE WHEN t.type = 'payment' THEN t.amount ELSE 0.0 END) AS payments
+            FROM customers c
+            LEFT JOIN transactions t ON t.customer_id = c.id AND t.admin_id = c.admin_id
+            WHERE c.id = ? AND c.admin_id = ?
+            GROUP BY c.id;
+            """, (customer_id, admin_id)) as cur:
+            row = await cur.fetchone()
 
-        if not customer:
+        if not row:
             return None
 
-        customer_data.update(customer)
-
-        # get transactions details
-        async with asyncio.TaskGroup() as tg:
-
-            totals_task = tg.create_task(self.conn.execute("""
-                SELECT TOTAL(CASE WHEN type = 'sale' THEN amount ELSE 0.0 END) as total_sales,
-                TOTAL(CASE WHEN type = 'payment' THEN amount ELSE 0.0 END) as total_payments
-                FROM transactions
-                WHERE customer_id = ? AND admin_id = ?;
-                """, (customer_id, admin_id)))
-            last_actions_task = tg.create_task(self.conn.execute("""
-                SELECT type, amount, created_at
-                FROM transactions
-                WHERE customer_id = ? AND admin_id = ?
-                ORDER BY created_at DESC
-                LIMIT 5;
-                """ , (customer_id, admin_id)))
-        totals_task, last_actions_task  = totals_task.result(), last_actions_task.result()
-
-        totals_dict = dict(await totals_task.fetchone())
-        total_payments = totals_dict.get("total_payments", 0)
-        total_sales = totals_dict.get("total_sales", 0)
+        customer_data = dict(row)
+
+        # get last transactions
+        async with self.read_conn.execute("""
+            SELECT type, amount, created_at
+            FROM transactions
+            WHERE customer_id = ? AND admin_id = ?
+            ORDER BY created_at DESC, id DESC
+            LIMIT 5;
+            """ , (customer_id, admin_id)) as cur:
+            fetched_actions = await cur.fetchall()
 
         def map_func(item):
             item = dict(item)
             item['created_at'] = datetime.strptime(item['created_at'], '%Y-%m-%d %H:%M:%S').strftime('%H:%M%p • %d %b %Y')
             return item
-        fetched_actions = await last_actions_task.fetchall()
-        last_actions = list(map(map_func,fetched_actions))
-
-        customer_data.update({
-            'payments': float(total_payments),
-            'sales': float(total_sales),
-            'recent': last_actions,
-        })
+        customer_data['recent'] = list(map(map_func, fetched_actions))
 
         return customer_data
 
     async def get_customer_transactions(self, customer_id: int, admin_id: int):
-        transactions = list(map(lambda row: dict(row),await self.conn.execute_fetchall("""
+        transactions = list(map(lambda row: dict(row),await self.read_conn.execute_fetchall("""
             SELECT *
             FROM transactions
             WHERE customer_id = ? AND admin_id = ?;
@@ -229,6 +309,7 @@ class DatabaseManager:
         
         return transactions
 
+    @serialized
     async def delete_customer(self, customer_id: int, admin_id: int, with_logging):
 
         try:
@@ -236,8 +317,9 @@ class DatabaseManager:
                 logging_info = await self.get_customer_by_id(customer_id, admin_id)
                 customer_transactions = await self.get_customer_transactions(customer_id, admin_id)
                 logging_info.update({'customer_transactions': customer_transactions})
-                await self.add_action_log('delete_customer', customer_id, admin_id,logging_info, False)
+                await self.add_action_log(ActionType.DELETE_CUSTOMER, customer_id, admin_id,logging_info, False)
 
+            self._forget_customer(customer_id)
             cur = await self.conn.execute("""
                 DELETE FROM customers WHERE id = ? AND admin_id = ? RETURNING fullname, phone, balance;
             """, (customer_id, admin_id))
@@ -252,6 +334,7 @@ class DatabaseManager:
             self.logger.exception(f"{exc}")
             raise Exception(f"Unexpected Error: {exc}") from exc
 
+    @serialized
     async def rename_customer(
         self, name: str, customer_id: int, admin_id: int,
         with_logging=True, logging_info: dict = None
@@ -262,8 +345,9 @@ class DatabaseManager:
             customer = await self.get_customer_by_id(customer_id, admin_id)
             old_name = customer['fullname']
             if with_logging:
-                await self.add_action_log('rename_customer',customer_id, admin_id, {'new_name': old_name}, with_commit=False)
+                await self.add_action_log(ActionType.RENAME_CUSTOMER,customer_id, admin_id, {'new_name': old_name}, with_commit=False)
 
+            self._forget_customer(customer_id)
             cursor = await self.conn.execute("""
                 UPDATE customers SET fullname = ? WHERE id = ? AND admin_id = ?;
                 """, (name, customer_id, admin_id))
@@ -272,16 +356,18 @@ class DatabaseManager:
             if cursor.rowcount == 0: raise AppError("Customer is NOT renamed. retry later!")
             return old_name
         except aiosqlite.IntegrityError as exc:
+            await self.conn.rollback()
             raise AppError(
                 f"Customer name '{name}' already exists"
             ) from exc
         except AppError:
             raise
         except Exception as exc:
-            self.conn.rollback()
+            await self.conn.rollback()
             self.logger.exception(f"Unexpected Error: {exc}")
             raise Exception(f"Unexpected Error: {exc}") from exc
 
+    @serialized
     async def change_customer_phone(
         self, phone: str, customer_id: int, admin_id: int,
         with_logging=True
@@ -290,8 +376,9 @@ class DatabaseManager:
             customer = await self.get_customer_by_id(customer_id, admin_id)
             old_phone = customer['phone']
             if with_logging:
-                await self.add_action_log('change_phone', customer_id, admin_id,{'new_phone': old_phone}, False)
+                await self.add_action_log(ActionType.CHANGE_PHONE, customer_id, admin_id,{'new_phone': old_phone}, False)
 
+            self._forget_customer(customer_id)
             cur = await self.conn.execute("""
                 UPDATE customers SET phone = ? WHERE id = ? AND admin_id = ? RETURNING fullname;
             """, (phone, customer_id, admin_id))
@@ -318,34 +405,33 @@ class DatabaseManager:
         balance_delta = sign * abs(amount)
 
         # add new transaction + adjust customer balance
-        cursor = await self.conn.execute("""
-            UPDATE customers SET balance = balance + ? WHERE id = ? RETURNING balance, fullname;
-        """, (balance_delta, customer_id))
+        self._forget_customer(customer_id)
+        cursor = await self.conn.execute(_UPDATE_BALANCE, (balance_delta, customer_id))
         return dict(await cursor.fetchone())
 
+    @serialized
     async def add_transaction(
         self, amount: float, type_: str, description: str, customer_id: int, admin_id: int,
         with_commit=True, with_logging=True
     ) -> dict:
-        """Insert transaction and return created transaction as a dict"""
+        """Insert transaction and return created transaction (with customer's `new_balance`) as a dict"""
 
 
         try:
             if type_ not in ('sale', 'payment'):
                 raise AppError('Invalid transaction type')
             
-            await self.update_balance(amount, type_, customer_id)
+            updated_customer = await self.update_balance(amount, type_, customer_id)
 
-            cur = await self.conn.execute("""
-                INSERT INTO transactions (amount, type, customer_id, admin_id, description)
-                VALUES (?, ?, ?, ?, ?) RETURNING id;
-            """, (amount, type_, customer_id, admin_id, description))
+            cur = await self.conn.execute(_INSERT_TRANSACTION, (amount, type_, customer_id, admin_id, description))
             transaction = dict(await cur.fetchone())
 
             if with_logging:
-                await self.add_action_log('add_transaction', customer_id, admin_id, transaction, False) # bookmark: do not store the entire transaction in log...
+                # only the id is needed to undo it
+                await self.add_action_log(ActionType.ADD_TRANSACTION, customer_id, admin_id, {'id': transaction['id']}, False)
             if with_commit:
                 await self.conn.commit()
+            transaction['new_balance'] = updated_customer['balance']
             return transaction
         except AppError:
             raise
@@ -354,18 +440,21 @@ class DatabaseManager:
             await self.conn.rollback()
             raise Exception(f"Unexpected Error: {exc}") from exc
 
-    async def restore_transactions(self, transactions):
+    async def restore_transactions(self, transactions, with_commit=True):
+        """re-insert deleted transactions (keeping their ids) as one executemany batch"""
         try:
-            cur = await self.conn.executemany("""
+            await self.conn.executemany("""
                     INSERT INTO transactions (id, amount, customer_id, admin_id, description, type, created_at)
                     VALUES (:id, :amount, :customer_id, :admin_id, :description, :type, :created_at);
                 """, transactions)
-            await self.conn.commit()
+            if with_commit:
+                await self.conn.commit()
         except Exception as exc:
             self.logger.exception(str(exc))
             await self.conn.rollback()
             raise Exception(f"Unexpected Error: {exc}") from exc
 
+    @serialized
     async def delete_transaction(self, transaction_id):
         try:
             cur = await self.conn.execute("""
@@ -385,31 +474,41 @@ class DatabaseManager:
             raise Exception(f"Unexpected Error: {exc}") from exc
 
     # ACTION_LOG Methods
-    async def add_action_log(self, action_type: str, customer_id: int, admin_id: int, action_info: dict, with_commit: bool = True):
-        payload = json.dumps(action_info)
-        await self.conn.execute("""
-                INSERT INTO action_logs (action_type, customer_id, admin_id, payload)
-                VALUES (?, ?, ?, ?);
-            """, (action_type, customer_id, admin_id, payload))
+    async def add_action_log(self, action_type: ActionType, customer_id: int, admin_id: int, action_info: dict, with_commit: bool = True):
+        payload = orjson.dumps(action_info).decode()
+        await self.conn.execute(_INSERT_ACTION_LOG, (action_type, customer_id, admin_id, payload))
         if with_commit:
             await self.conn.commit()
 
+    @serialized
     async def clear_old_logs(self):
-        async with (await self.conn.cursor()) as cur:
-            # archive old logs
-            await cur.execute("""
-                    INSERT INTO action_logs_archive
-                    SELECT * FROM action_logs
-                    WHERE created_at < datetime('now', '-30 day');
-            """)
-            # delete from logs table
-            await cur.execute("""
-                DELETE FROM action_logs
-                WHERE created_at < datetime('now', '-30 day');
-            """)
-        await self.conn.commit()
+        """move logs older than 30 days to the archive table, in one transaction"""
+        # one cutoff for both statements, so every deleted log is archived first (created_at is UTC)
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=30)).strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            async with (await self.conn.cursor()) as cur:
+                # archive old logs
+                await cur.execute("""
+                        INSERT INTO action_logs_archive
+                        SELECT * FROM action_logs
+                        WHERE created_at < ?;
+                """, (cutoff,))
+                # delete from logs table
+                await cur.execute("""
+                    DELETE FROM action_logs
+                    WHERE created_at < ?;
+                """, (cutoff,))
+            await self.conn.commit()
+        except Exception as exc:
+            await self.conn.rollback()
+            self.logger.exception(str(exc))
+            raise Exception(f"Unexpected Error: {exc}") from exc
+        # keep the WAL file from growing without bound
+        await self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
 
+    @serialized
     async def undo_last_action(self, admin_id):
+        """pop the last action log of the admin, with its payload decoded to a dict"""
         cur = await self.conn.execute("""
             SELECT * FROM action_logs
             WHERE admin_id = ?
@@ -417,16 +516,27 @@ class DatabaseManager:
             LIMIT 1;
         """, (admin_id,))
         log = await cur.fetchone()
+        if log is None:
+            raise AppError("Nothing to undo")
         await self.conn.execute("DELETE FROM action_logs WHERE id = ?", (log['id'],))
 
         await self.conn.commit()
 
-        return dict(log)
+        log = dict(log)
+        log['payload'] = orjson.loads(log['payload'])
+        return log
 
     async def close(self) -> None:
-        """Close DB connection."""
+        """Close DB connections."""
+        if self.read_conn is not None:
+            try:
+                await self.read_conn.close()
+            finally:
+                self.read_conn = None
         if self.conn is not None:
             try:
+                # refresh planner statistics so the indexes keep being used
+                await self.conn.execute("PRAGMA optimize;")
                 await self.conn.close()
             finally:
                 self.conn = None
\ No newline at end of file
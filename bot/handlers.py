@@ -1,16 +1,64 @@
-from functools import reduce
-import json
-from typing import Optional
+import math
+from operator import itemgetter
+from types import MappingProxyType
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
-from bot.helpers import is_valid_name, normalize_fullname, is_valid_phone, get_args, normalize_name, normalize_phone
-from bot.database_manager import DatabaseManager, AppError
+from bot.helpers import (
+    is_valid_name, normalize_fullname, is_valid_phone, get_args, normalize_name, normalize_phone,
+    get_selected_customer, set_selected_customer,
+)
+from bot.database_manager import DatabaseManager, AppError, ActionType
 from config import INVALID_USAGE, NO_SELECTED_CUSTOMER_WARNING,WELCOME_MSG
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+_SEP = '  ────୨ৎ────'
+_SEP_LAST = '────୨ৎ────\n\n   【 💸 = sale │ 💰 = payment 】 \n '
+
+_TRANSACTION_EMOJI = {'sale': '💸', 'payment': '💰'}
+_SUMMARY_FIELDS = itemgetter('fullname', 'phone', 'payments', 'sales', 'balance', 'recent')
+
+# response templates
+_SELECTED_CUSTOMER_TMPL = (
+    "Selected <b>{name}</b>...\n"
+    "Now, you can... \n"
+    "- to view customer's info, use command:\n"
+    "   <code>/summary</code>\n"
+    "- to add transactions, use command:\n"
+    "   <code>/addtransaction amount*|type*|info</code>"
+)
+_SUMMARY_TMPL = """
+<b>「✦{name}✦」</b>
+  ─•────
+Phone: <b><code>{phone}</code></b>
+
+Total Payments: <b>{payments:.1f}</b>
+Total Sales: <b>{sales:.1f}</b>
+Balance: <b>{balance:.1f}</b>
+
+Recent Transactions:
+<blockquote>
+{recent}
+</blockquote>
+    """
+_TRANSACTION_ADDED_TMPL = (
+    "「 ✦<b>{name}</b>✦ 」\n"
+    "  ─•────\n"
+    "Successfully added <b>{type}</b> of <b>{amount:.2f}</b>\n"
+    "{description}\n"
+    "\n<b>Account Balance: {balance:.2f}</b>"
+)
+
+def format_transaction(transaction, is_last):
+    """format one entry of the recent transactions shown by /summary"""
+    return (
+        f"<b>{_TRANSACTION_EMOJI[transaction['type']]} {transaction['amount']:.1f}</b>\n"
+        f"                  {transaction['created_at']}\n"
+        f"{_SEP_LAST if is_last else _SEP}\n "
+    )
+
 # General handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
@@ -50,8 +98,8 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Show each search result as a user-selectable option.
     keyboard = [
-        [InlineKeyboardButton(customer["fullname"].upper(), callback_data=f"customer_select:{customer["id"]}")]
-        for customer in customers
+        [InlineKeyboardButton(fullname, callback_data=f"customer_select:{customer_id}")]
+        for customer_id, fullname in customers
     ]
 
     await update.effective_message.reply_text(text='Choose One Customer:', reply_markup=InlineKeyboardMarkup(keyboard))
@@ -87,20 +135,13 @@ async def select_customer_command(update: Update, context: ContextTypes.DEFAULT_
         return
 
     # Feedback message
-    feedback_msg = '\n'.join([
-        f"Selected <b>{selected_customer['fullname'].upper()}</b>...",
-        "Now, you can... ",
-        "- to view customer's info, use command:",
-        "   <code>/summary</code>",
-        "- to add transactions, use command:",
-        "   <code>/addtransaction amount*|type*|info</code>",
-    ])
+    feedback_msg = _SELECTED_CUSTOMER_TMPL.format(name=selected_customer['fullname'].upper())
     await query.delete_message()
     await update.effective_message.reply_html(feedback_msg)
 
 async def add_customer(
     fullname, phone, admin_id, db_manager: DatabaseManager, user_data, with_logging,
-    customer_id=None, created_at=None, balance=None
+    customer_id=None, created_at=None, balance=None, customer_transactions=None
 ):
     fullname, phone = normalize_fullname(fullname), normalize_phone(phone)
 
@@ -127,10 +168,10 @@ async def add_customer(
         old_info = {
             'customer_id': customer_id,
             'created_at': created_at,
-            'balance': balance
+            'balance': balance,
+            'customer_transactions': customer_transactions,
         } if not with_logging else None
         result = await db_manager.add_customer(fullname, phone, admin_id, with_logging, old_info)
-        customer_id = result['customer_id']
 
     except AppError as exc:
         return {
@@ -143,13 +184,18 @@ async def add_customer(
             'error': "Something went wrong. Please try again later."
         }
 
-    # select added customer
+    # select added customer, straight from the inserted row
     if with_logging:
-        await select_customer(customer_id, admin_id, db_manager, user_data)
+        customer = result['customer']
+        set_selected_customer(
+            user_data,
+            {k: customer[k] for k in ("customer_id", "fullname", "balance")}
+        )
     undo_details = result['undo_details']
     return {
         'ok': True,
         'error': None,
+        'fullname': fullname,
         'undo_details': undo_details,
         'action_type': 'delete-customer'
     }
@@ -163,17 +209,22 @@ async def add_customer_command(update: Update, context: ContextTypes.DEFAULT_TYP
         err_msg = INVALID_USAGE['addcustomer']
         return await update.effective_message.reply_html(err_msg)
 
-    fullname, phone = normalize_fullname(args[0]), normalize_phone(args[1])
-
     admin_id = update.effective_user.id
     db_manager: DatabaseManager = context.bot_data['db_manager']
 
-    result = await add_customer(fullname, phone, admin_id, db_manager, context.user_data, True)
+    # add_customer normalizes fullname and phone
+    result = await add_customer(args[0], args[1], admin_id, db_manager, context.user_data, True)
     if not result['ok']:
         await update.effective_message.reply_text(result['error'])
         return
 
-    await update.effective_message.reply_text(f'New Customer: added {fullname.upper()}')
+    # confirm and report the selection in one message
+    await update.effective_message.reply_html('\n'.join([
+        f"New Customer: added <b>{result['fullname'].upper()}</b>",
+        "Customer is now selected, you can use:",
+        "   <code>/summary</code>",
+        "   <code>/addtransaction amount*|type*|info</code>",
+    ]))
 
 async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """get more info about selected customer"""
@@ -188,39 +239,22 @@ async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin_id = update.effective_user.id
 
     summary = await db_manager.get_customer_summary(customer_id, admin_id)
-
-    recent = summary['recent']
-    recent_actions = []
-
-    def format_transaction(transaction, is_last):
-        return "\n".join([
-            f"<b>{'💸' if transaction['type'] == 'sale' else '💰'} {transaction['amount']:.1f}</b>",
-            f"                  {transaction['created_at']}",
-            '  ────୨ৎ────' if not is_last 
-            else '────୨ৎ────\n\n   【 💸 = sale │ 💰 = payment 】 \n ',
-            ' '
-        ])
-
-    for i in range(len(recent)):
-        item = recent[i]
-        recent_actions.append(format_transaction(item, i == len(recent)-1))
-    recent_actions_formatted = "".join(recent_actions) if len(recent_actions)>0 else "No transactions found."
-    logger.info(f'payments {summary['payments']:.1f}')
-
-    await update.effective_message.reply_html(text=f"""
-<b>「✦{summary['fullname'].upper()}✦」</b>
-  ─•────
-Phone: <b><code>{summary['phone']}</code></b>
-
-Total Payments: <b>{summary['payments']:.1f}</b>
-Total Sales: <b>{summary['sales']:.1f}</b>
-Balance: <b>{summary['balance']:.1f}</b>
-
-Recent Transactions:
-<blockquote>
-{recent_actions_formatted}
-</blockquote>
-    """)
+    fullname, phone, payments, sales, balance, recent = _SUMMARY_FIELDS(summary)
+
+    last = len(recent) - 1
+    recent_actions_formatted = "".join(
+        format_transaction(item, i == last) for i, item in enumerate(recent)
+    ) or "No transactions found."
+    logger.info(f'payments {payments:.1f}')
+
+    await update.effective_message.reply_html(text=_SUMMARY_TMPL.format(
+        name=fullname.upper(),
+        phone=phone,
+        payments=payments,
+        sales=sales,
+        balance=balance,
+        recent=recent_actions_formatted,
+    ))
 
 # Transaction handlers
 async def add_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -234,7 +268,7 @@ async def add_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # syntax validation
     args = get_args(update.effective_message.text)
-    if len(args) == 0:
+    if len(args) < 2:
         err_msg = INVALID_USAGE['addtransaction']
         await update.effective_message.reply_html(err_msg)
         return
@@ -242,8 +276,11 @@ async def add_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     type_ = normalize_name(args[1])
     description = "" if len(args)<3 else args[2]
     try:
-        amount = float(normalize_name(args[0]))
+        amount = float(args[0].replace(',', '.'))
     except ValueError:
+        amount = math.nan
+    # float() also accepts "nan", "inf" and overflowing values like "1e999"
+    if not math.isfinite(amount):
         await update.effective_message.reply_html("Invalid <b>amount</b> value: amount must be a number")
         return
 
@@ -262,23 +299,22 @@ async def add_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     customer_id = selected_customer['customer_id']
     fullname = selected_customer['fullname']
 
-    amount = float(amount)
     try:
         transaction = await db_manager.add_transaction(amount, type_, description, customer_id, admin_id)
     except Exception as exc:
         await update.effective_message.reply_text("Something went wrong. Please try again later.")
         return
-    selected_customer['balance'] = (await db_manager.get_customer_by_id(customer_id, admin_id))['balance']
-    new_balance = selected_customer['balance']
+    new_balance = transaction['new_balance']
+    selected_customer['balance'] = new_balance
 
 
-    feedback_msg = '\n'.join([
-            f"「 ✦<b>{fullname.upper()}</b>✦ 」",
-            "  ─•────",
-            f"Successfully added <b>{type_.upper()}</b> of <b>{amount:.2f}</b>",
-            f"<b>Description: </b> {description}" if len(args)>2 else '',
-            f"\n<b>Account Balance: {new_balance:.2f}</b>",
-    ])
+    feedback_msg = _TRANSACTION_ADDED_TMPL.format(
+        name=fullname.upper(),
+        type=type_.upper(),
+        amount=amount,
+        description=f"<b>Description: </b> {description}" if description else '',
+        balance=new_balance,
+    )
 
     await update.effective_message.reply_html(feedback_msg)
     
@@ -288,7 +324,11 @@ async def delete_transaction(
     customer_id: int, admin_id: int, id: int,
     db_manager:DatabaseManager, user_data: dict, with_logging = True
 ):
+    # balance comes back from the DELETE/UPDATE ... RETURNING, no extra lookup needed
     details = await db_manager.delete_transaction(id)
+    selected_customer = get_selected_customer(user_data)
+    if selected_customer and selected_customer['customer_id'] == customer_id:
+        selected_customer['balance'] = details['balance']
     return {
         'action_type': 'record-transaction',
         'undo_details': {
@@ -309,10 +349,10 @@ async def delete_customer(
 
     try:
         deleted_customer = await db_manager.delete_customer(customer_id, admin_id, with_logging)
-    except AppError:
+    except AppError as exc:
         return {
             'ok': False,
-            'error': f"{str(exc)}",
+            'error': str(exc),
         }
     except Exception as exc:
         return {
@@ -337,11 +377,12 @@ async def delete_customer(
     }
 
 async def delete_customer_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.effective_message
 
     # get selected customer
     selected_customer = get_selected_customer(context.user_data)
     if not selected_customer:
-        await update.effective_message.reply_html(NO_SELECTED_CUSTOMER_WARNING)
+        await msg.reply_html(NO_SELECTED_CUSTOMER_WARNING)
         return
 
     # delete customer from database
@@ -353,14 +394,10 @@ async def delete_customer_command(update: Update, context: ContextTypes.DEFAULT_
 
     result = await delete_customer(customer_id, admin_id, db_manager, context.user_data)
     if not result['ok']:
-        msg_err = result['error']
-        if msg_err.startswith('Error:'):
-            await update.effective_message.reply_text(f"Error: {msg_err}")
-        elif msg_err.startswith('Unknown Error:'):
-            await update.effective_message.reply_text(f"Error: Customer is not Deleted... retry later")
+        await msg.reply_text(f"Error: {result['error']}")
         return
 
-    await update.effective_message.reply_text(f"Customer {customer_name} is deleted successfully")
+    await msg.reply_text(f"Customer {customer_name} is deleted successfully")
 
 async def rename_customer(
     new_name: str, 
@@ -400,8 +437,8 @@ async def rename_customer(
 
     # update context
     selected_customer = get_selected_customer(user_data)
-    if selected_customer['customer_id'] == customer_id:
-        rename_customer_state(user_data, new_name)
+    if selected_customer and selected_customer['customer_id'] == customer_id:
+        selected_customer['fullname'] = new_name
     undo_dict = {
         'Current Name': new_name,
         'Was Renamed To': old_name,
@@ -425,7 +462,7 @@ async def rename_customer_command(update: Update, context: ContextTypes.DEFAULT_
 
     args = get_args(update.effective_message.text)
     if len(args) == 0:
-        err_msg = INVALID_USAGE['renamecustomer']
+        err_msg = INVALID_USAGE['rename']
         await update.effective_message.reply_html(err_msg)
         return
 
@@ -517,72 +554,57 @@ async def change_phone_command(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     # feedback
-    await update.effective_message.reply_text(
-        f'Customer Name Has Been Changed To:\n {new_phone.upper()}'
+    await update.effective_message.reply_html(
+        f"Phone of <b>{result['undo_details']['Full Name'].upper()}</b> has been changed to:\n"
+        f" <code>{result['proposed_phone']}</code>"
     )
 
+# inverse handler of each logged action type, used by /undo
+_INVERSE = MappingProxyType({
+    ActionType.RENAME_CUSTOMER: rename_customer,
+    ActionType.CHANGE_PHONE: change_phone,
+    ActionType.DELETE_CUSTOMER: add_customer,
+    ActionType.ADD_CUSTOMER: delete_customer,
+    ActionType.ADD_TRANSACTION: delete_transaction,
+})
+
 async def undo_last_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    inverse = {
-        "rename_customer": rename_customer,
-        "change_phone": change_phone,
-        "delete_customer": add_customer,
-        "add_customer": delete_customer,
-        "add_transaction": delete_transaction,
-    }
-    kwargs = dict()
     # fetch last action log
     db_manager: DatabaseManager = context.bot_data['db_manager']
     admin_id = update.effective_sender.id
-    action_log = await db_manager.undo_last_action(admin_id)
-    action_type = action_log['action_type']
+    try:
+        action_log = await db_manager.undo_last_action(admin_id)
+        action_type = action_log['action_type']
+        inverse_func = _INVERSE.get(action_type)
+        if inverse_func is None:
+            raise AppError(f"'{action_type}' command can not be undone")
+    except AppError as exc:
+        await update.effective_message.reply_text(str(exc))
+        return
 
-    payload = json.loads(action_log['payload'])
-    customer_transactions = payload.pop('customer_transactions', None)
+    payload = action_log['payload']
     customer_id = action_log['customer_id']
 
-    inverse_func = inverse[action_type]
-    kwargs.update({
-        "db_manager": db_manager,
-        "user_data": context.user_data,
-        "customer_id":customer_id,
-        "admin_id":admin_id,
-        "with_logging": False,
-    })
-    kwargs.update(payload)
-
-    result = await inverse_func(**kwargs)
-    
-    if customer_transactions:
-        await db_manager.restore_transactions(customer_transactions)
+    payload.update(
+        db_manager=db_manager,
+        user_data=context.user_data,
+        customer_id=customer_id,
+        admin_id=admin_id,
+        with_logging=False,
+    )
+    result = await inverse_func(**payload)
+    if not result.get('ok', True):
+        await update.effective_message.reply_text(result['error'])
+        return
 
     details = result['undo_details']
     action_type = result['action_type']
     await update.effective_message.reply_html(format_undo_msg(details, action_type))
 
 
-# managing context state
-def get_selected_customer(user_data: dict)->Optional[dict]:
-    context_state = user_data.get("context_state", {})
-    selected_customer = context_state.get("selected_customer", None)
-    return selected_customer
-
-def set_selected_customer(user_data: dict, selected_customer=None)->None:
-    context_state = user_data.setdefault('context_state', {})
-    context_state['selected_customer'] = selected_customer
-
-def rename_customer_state(user_data: dict, new_name: str)->None:
-    context_state = user_data['context_state']
-    customer = context_state['selected_customer']
-    customer['fullname'] = new_name
-    
 def format_undo_msg(details: dict, action_type):
-    undo_details = "\n".join(
-        f" → <b>{k}:</b> {details[k]}"
-        for k in details
-    )
-
-    return "\n".join([
+    return "\n".join((
         "<b>Undo Complete</b>",
         f"The <b>{action_type}</b> command has been cancelled.",
-        undo_details
-    ])
\ No newline at end of file
+        *(f" → <b>{k}:</b> {v}" for k, v in details.items()),
+    ))
@@ -1,23 +1,27 @@
-from functools import reduce
 import re
-from typing import List
-from config import *
+from typing import List, Optional
+from config import PHONE_RE, NAME_RE
+
+__all__ = [
+    "normalize_phone", "is_valid_phone", "is_valid_name", "normalize_name", "normalize_fullname",
+    "get_args", "get_selected_customer", "set_selected_customer",
+]
 
 def normalize_phone(phone: str) -> str:
     """Convert phone number to digits only(Remove all non-digits)"""
-    digits = re.sub(r"\D", "", phone)
+    digits = ''.join(filter(str.isdecimal, phone)) # str.isdecimal matches exactly what r"\d" does
     return digits
 
 def is_valid_phone(
     number: str,
-    pattern: str = DEFAULT_PHONE_PATTERN,
+    pattern: re.Pattern = PHONE_RE,
     ) -> bool:
     """Return True if the number matches a local/national phone format."""
-    return re.match(pattern, number.strip()) is not None
+    return pattern.match(number.strip()) is not None
 
 def is_valid_name(
     name: str,
-    pattern: str = DEFAULT_NAME_PATTERN
+    pattern: re.Pattern = NAME_RE
 ) -> bool:
     """
     Return True if the name includes:
@@ -25,7 +29,7 @@ def is_valid_name(
     - middle name (optional)
     - Maximum length: 30 characters
     """
-    return re.match(pattern, name.strip()) is not None
+    return pattern.match(name.strip()) is not None
 
 def normalize_name(name: str) -> str:
     return name.strip().lower()
@@ -33,18 +37,22 @@ def normalize_name(name: str) -> str:
 def normalize_fullname(
     name: str
 ) -> str:
-    """return fullname"""
-    name_parts = re.split(r"\s+", name)
-    first, last = normalize_name(name_parts[0]), normalize_name(name_parts[-1])
-    middle = ' '.join(normalize_name(p) for p in name_parts[1:-1])
-
-    return f"{first} {middle + ' ' if len(middle)>0 else ''}{last}"
+    """return lowercase fullname with single spaces, or "" if it has less than two parts"""
+    name_parts = name.lower().split() # split() also collapses any whitespace
+    if len(name_parts) < 2:
+        return ""
+    return ' '.join(name_parts)
 
 def get_args(msg_txt: str) -> List[str]:
-    try:
-        args_txt = msg_txt.split(" ", maxsplit=1)[1].strip('|') # discard command part
-    except IndexError:
-        args_txt = ""
-    args = args_txt.split("|") # "|" is args delimeter
-    refined_args = filter(lambda arg: len(arg) > 0 ,map(lambda item: item.strip(), args)) # remove unwanted spaces and empty arguments
-    return list(refined_args)
\ No newline at end of file
+    parts = msg_txt.split(maxsplit=1) # discard command part
+    if len(parts) < 2:
+        return []
+    # "|" is args delimeter; remove unwanted spaces and empty arguments
+    return [arg for arg in (item.strip() for item in parts[1].split("|")) if arg]
+
+# managing context state
+def get_selected_customer(user_data: dict)->Optional[dict]:
+    return user_data.get("selected_customer")
+
+def set_selected_customer(user_data: dict, selected_customer=None)->None:
+    user_data["selected_customer"] = selected_customer
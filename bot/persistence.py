@@ -0,0 +1,170 @@
+import asyncio
+import contextlib
+import logging
+from typing import Optional
+import aiosqlite
+import orjson
+from telegram.ext import BasePersistence, PersistenceInput
+
+class CustomPersistence(BasePersistence):
+    """
+    Persist user_data and conversation states in SQLite.
+    all reads/writes share one long-lived aiosqlite connection.
+    writes are buffered in memory and saved every `flush_interval` seconds in one transaction.
+    chat_data, bot_data and callback_data are not stored (bot_data holds the db_manager).
+    """
+
+    def __init__(self, db_path: str, update_interval: float = 30, flush_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(chat_data=False, bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.conn: aiosqlite.Connection = None
+        self.logger = logging.getLogger(__name__)
+        self._flush_task: Optional[asyncio.Task] = None
+        # serialized data waiting to be written, None marks a deleted row
+        self._pending_user: dict[int, Optional[str]] = {}
+        self._pending_conv: dict[tuple[str, str], Optional[str]] = {}
+
+    async def initialize(self) -> None:
+        """
+        Open the connection and create required tables. calling it again does nothing.
+        PTB loads persisted data during Application.initialize (before post_init), so the
+        first get_* call runs it on the application's loop; it can also be awaited directly.
+        """
+        if self.conn is not None:
+            return
+
+        self.conn = await aiosqlite.connect(self.db_path)
+        await self.conn.execute("PRAGMA journal_mode = WAL;")
+        await self.conn.execute("PRAGMA synchronous = NORMAL;")
+        await self.conn.execute("PRAGMA busy_timeout = 5000;")
+        await self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS user_data (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            ) STRICT;
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                PRIMARY KEY (name, key)
+            ) STRICT;
+        """)
+        await self.conn.commit()
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._write_pending()
+            except Exception as exc:
+                # keep the loop alive, the buffered data is retried on next run
+                self.logger.exception(f"{exc}")
+
+    async def _write_pending(self) -> None:
+        """Write all buffered changes in a single transaction."""
+        if not (self._pending_user or self._pending_conv):
+            return
+        pending_user, self._pending_user = self._pending_user, {}
+        pending_conv, self._pending_conv = self._pending_conv, {}
+        try:
+            await self.conn.executemany("""
+                INSERT INTO user_data (user_id, data) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET data = excluded.data;
+            """, [(user_id, data) for user_id, data in pending_user.items() if data is not None])
+            await self.conn.executemany(
+                "DELETE FROM user_data WHERE user_id = ?;",
+                [(user_id,) for user_id, data in pending_user.items() if data is None],
+            )
+            await self.conn.executemany("""
+                INSERT INTO conversations (name, key, state) VALUES (?, ?, ?)
+                ON CONFLICT (name, key) DO UPDATE SET state = excluded.state;
+            """, [(*name_key, state) for name_key, state in pending_conv.items() if state is not None])
+            await self.conn.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?;",
+                [name_key for name_key, state in pending_conv.items() if state is None],
+            )
+            await self.conn.commit()
+        except BaseException: # also when cancelled mid-write, e.g. by flush()
+            # put back what was not saved, without overriding newer changes
+            self._pending_user = pending_user | self._pending_user
+            self._pending_conv = pending_conv | self._pending_conv
+            await self.conn.rollback()
+            raise
+
+    # user_data
+    async def get_user_data(self) -> dict[int, dict]:
+        await self.initialize()
+        async with self.conn.execute("SELECT user_id, data FROM user_data;") as cur:
+            return {user_id: orjson.loads(data) async for user_id, data in cur}
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._pending_user[user_id] = orjson.dumps(data).decode()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending_user[user_id] = None
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        """user_data is only changed by this bot, nothing to refresh"""
+
+    # conversations
+    async def get_conversations(self, name: str) -> dict[tuple, object]:
+        await self.initialize()
+        async with self.conn.execute(
+            "SELECT key, state FROM conversations WHERE name = ?;", (name,)
+        ) as cur:
+            return {tuple(orjson.loads(key)): orjson.loads(state) async for key, state in cur}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        state = None if new_state is None else orjson.dumps(new_state).decode()
+        self._pending_conv[(name, orjson.dumps(key).decode())] = state
+
+    # not stored data
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Save buffered changes and close the connection, called by the application on shutdown."""
+        if self.conn is None and (self._pending_user or self._pending_conv):
+            # never initialized, open it just to save what was buffered
+            await self.initialize()
+        if self._flush_task is not None:
+            # wait for the cancelled task, an interrupted write puts its data back first
+            self._flush_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flush_task
+            self._flush_task = None
+        if self.conn is not None:
+            try:
+                await self._write_pending()
+            finally:
+                await self.conn.close()
+                self.conn = None
@@ -0,0 +1,49 @@
+import asyncio
+import sys
+from typing import Any, Awaitable
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates of different chats concurrently, while updates of the same chat
+    are handled one by one in the order they arrived.
+    PTB's process_update holds its own semaphore while an update waits for its chat lock,
+    so that one is left unbounded and the real limit is applied once the chat lock is held;
+    otherwise a burst from one chat would fill every slot and stall all other chats.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(sys.maxsize)
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        self._running_limit = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks: dict[int, asyncio.Lock] = {}
+        self._pending: dict[int, int] = {} # updates of each chat that are running or waiting
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._running_limit:
+                await coroutine
+            return
+
+        chat_id = chat.id
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        self._pending[chat_id] = self._pending.get(chat_id, 0) + 1
+        try:
+            async with lock, self._running_limit:
+                await coroutine
+        finally:
+            # forget idle chats, so locks don't pile up
+            self._pending[chat_id] -= 1
+            if not self._pending[chat_id]:
+                del self._pending[chat_id]
+                del self._chat_locks[chat_id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chat_locks.clear()
+        self._pending.clear()
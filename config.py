@@ -1,16 +1,21 @@
+import re
 from os import path
+from typing import Final
 
-DEFAULT_PHONE_PATTERN = r"^\+?\(?\d{2,4}\)?[\s.-]?\d{3,4}[\s.-]?\d{3,4}$"
-DEFAULT_NAME_PATTERN = r"^[A-Za-z\-\']{2,20}(\s[A-Za-z]{1,20}){0,3}\s[A-Za-z]{2,20}$"
-DATABASE_PATH = path.join("data","app_database.db")
-NO_SELECTED_CUSTOMER_WARNING = """<b>Error: you must select a customer first...</b>
+DEFAULT_PHONE_PATTERN: Final[str] = r"^\+?\(?\d{2,4}\)?[\s.-]?\d{3,4}[\s.-]?\d{3,4}$"
+DEFAULT_NAME_PATTERN: Final[str] = r"^[A-Za-z\-\']{2,20}(\s[A-Za-z]{1,20}){0,3}\s[A-Za-z]{2,20}$"
+# compiled once at import time, reused by every validator
+PHONE_RE: Final[re.Pattern] = re.compile(DEFAULT_PHONE_PATTERN)
+NAME_RE: Final[re.Pattern] = re.compile(DEFAULT_NAME_PATTERN)
+DATABASE_PATH: Final[str] = path.join("data","app_database.db")
+NO_SELECTED_CUSTOMER_WARNING: Final[str] = """<b>Error: you must select a customer first...</b>
 
 <code>/search query</code>*
 
  query* : <b>name</b>/<b>phone</b>
  Note: <code>/search</code> will display all your customers
 """
-INVALID_USAGE = {
+INVALID_USAGE: Final[dict[str, str]] = {
     "addtransaction": '\n'.join([
         "<b>Incorrect Command Usage...</b>",
         "Usage: <code>/addtransaction amount*|type*|info</code>",
@@ -31,7 +36,7 @@ INVALID_USAGE = {
     
 }
 
-WELCOME_MSG = """
+WELCOME_MSG: Final[str] = """
 <b>Welcome to the Pay Track Bot
 
 I am here to help you manage customers, balances, and cash flow.  
@@ -1,47 +1,55 @@
 import asyncio
 import logging
 import os
+import re
+import signal
 from dotenv import load_dotenv
-from telegram.ext import (
-    ApplicationBuilder, CallbackQueryHandler, CommandHandler, PicklePersistence, PersistenceInput, MessageHandler
-)
+from telegram.ext import ApplicationBuilder, CallbackQueryHandler, CommandHandler
+from telegram.request import HTTPXRequest
 from bot import handlers
 from bot.database_manager import DatabaseManager
+from bot.persistence import CustomPersistence
+from bot.update_processor import PerChatUpdateProcessor
 from config import DATABASE_PATH
 
-def main():
+try:
+    import uvloop
+except ImportError: # uvloop does not support windows
+    uvloop = None
 
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO,
-    )
-    logging.getLogger("httpx").setLevel(logging.WARNING)
+_CUSTOMER_SELECT = re.compile(r"^customer_select:")
+
+async def main_async():
 
     load_dotenv()
     BOT_TOKEN = os.getenv("BOT_TOKEN")
     if not BOT_TOKEN:
         raise ValueError("invalid bot token")
 
-    persistence = PicklePersistence(
-        filepath="data.pkl",
-        update_interval=30,
-        store_data=PersistenceInput(chat_data=False),
-    )
-
+    # db connections, persistence flush task and the bot all live on this one running loop
     db = DatabaseManager(DATABASE_PATH)
-    async def on_stop(app):
-        await db.close()
+    await db.init_database()
+
+    # user_data and conversations are kept in the app database, next to the customers
+    persistence = CustomPersistence(DATABASE_PATH, update_interval=30)
+    await persistence.initialize()
 
-    async def on_start(app):
-        await db.init_database()
-        app.bot_data["db_manager"] = db
+    # share persistent HTTP/2 connections between all bot replies
+    request = HTTPXRequest(
+        connection_pool_size=64,
+        http_version="2",
+        read_timeout=10,
+        pool_timeout=5,
+    )
+    get_updates_request = HTTPXRequest(http_version="2")
 
     application = (
         ApplicationBuilder()
         .token(BOT_TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .concurrent_updates(PerChatUpdateProcessor(max_concurrent_updates=32))
         .persistence(persistence)
-        .post_init(on_start)
-        .post_shutdown(on_stop)
         .build()
     )
 
@@ -49,7 +57,7 @@ def main():
     all_handlers = [
         CommandHandler('start', handlers.start),
         CommandHandler('search', handlers.search),
-        CallbackQueryHandler(handlers.select_customer_command, pattern=r"^customer_select:"),
+        CallbackQueryHandler(handlers.select_customer_command, pattern=_CUSTOMER_SELECT),
         CommandHandler("summary", handlers.summary),
         CommandHandler("addcustomer", handlers.add_customer_command),
         CommandHandler("addtransaction", handlers.add_transaction),
@@ -59,12 +67,49 @@ def main():
         CommandHandler("undo", handlers.undo_last_action),
     ]
 
-    application.add_handlers(all_handlers)
+    application.add_handlers({0: all_handlers})
+
+    # stop on Ctrl+C / SIGTERM, like run_polling does
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError: # windows: Ctrl+C cancels the main task instead
+            pass
 
     # start program
-    application.run_polling()
-    
+    try:
+        async with application: # initialize() ... shutdown() (also flushes persistence)
+            application.bot_data["db_manager"] = db
+            await application.start()
+            await application.updater.start_polling()
+            try:
+                await stop_event.wait()
+            finally:
+                if application.updater.running:
+                    await application.updater.stop()
+                if application.running:
+                    await application.stop()
+    finally:
+        # application.shutdown() skips flushing when initialize() failed, so close it here too
+        await persistence.flush()
+        await db.close()
+
+def main():
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    # faster event loop for all handlers and aiosqlite calls
+    if uvloop is not None:
+        uvloop.run(main_async())
+    else:
+        asyncio.run(main_async())
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
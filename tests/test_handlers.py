@@ -0,0 +1,57 @@
+import unittest
+from types import SimpleNamespace
+
+from bot import handlers
+from bot.database_manager import AppError
+
+
+class FailingDatabaseManager:
+    """db_manager whose delete_customer always raises `error`"""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+    async def delete_customer(self, customer_id, admin_id, with_logging):
+        raise self.error
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def reply_html(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def make_update_and_context(db_manager):
+    message = FakeMessage()
+    update = SimpleNamespace(effective_message=message, effective_user=SimpleNamespace(id=1))
+    context = SimpleNamespace(
+        user_data={"selected_customer": {"customer_id": 7, "fullname": "john doe", "balance": 0.0}},
+        bot_data={"db_manager": db_manager},
+    )
+    return update, context, message
+
+
+class DeleteCustomerCommandTest(unittest.IsolatedAsyncioTestCase):
+    async def test_unexpected_error_is_replied(self):
+        update, context, message = make_update_and_context(FailingDatabaseManager(Exception("disk I/O error")))
+
+        await handlers.delete_customer_command(update, context)
+
+        self.assertEqual(message.replies, ["Error: Something went wrong. Please try again later."])
+        self.assertIsNotNone(context.user_data["selected_customer"])
+
+    async def test_app_error_is_replied(self):
+        update, context, message = make_update_and_context(FailingDatabaseManager(AppError("Customer is NOT deleted")))
+
+        await handlers.delete_customer_command(update, context)
+
+        self.assertEqual(message.replies, ["Error: Customer is NOT deleted"])
+
+
+if __name__ == "__main__":
+    unittest.main()